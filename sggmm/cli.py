@@ -2,38 +2,49 @@
 Module containing the logic of the command line interface of the Supergiant Games Mod Manager
 """
 import logging
+import mmap
 import os
 import re
 import shutil
+import stat
+import sys
+from codecs import BOM_UTF8
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Optional
+from typing import Callable, Iterator, List, Optional
 from enum import StrEnum
 
 import typer
-from rich.logging import RichHandler
 from typing_extensions import Annotated
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(message)s",
-    datefmt="[%X]",
-    handlers=[RichHandler()]
-    # handlers=[logging.FileHandler("cli.log", mode="w"), logging.StreamHandler()],
-)
+if sys.platform.startswith("linux"):
+    import fcntl
+
+    FICLONE: int = getattr(fcntl, "FICLONE", 0x40049409)
 
 LOGGER = logging.getLogger(__name__)
+LOGGER.addHandler(logging.NullHandler())
 
-REGEX_SUBSTITUTION: re.Pattern[str] = re.compile(
-    r"|".join(
+REGEX_SUBSTITUTION: re.Pattern[bytes] = re.compile(
+    rb"|".join(
         [
-            r"(\s?::.*?$\s?)",  # Single line comment
-            r"(-:(?:.|\s)*?:-\s?)",  # Multiline comment
-            r"(^\s+)",  # Empty lines and whitespace
+            rb"(^[ \t]*::.*\n?)",  # Comment line, including its line break
+            rb"(^\s+)",  # Empty lines and whitespace
+            rb"([ \t]*::.*)",  # Single line comment after a command
+            rb"(-:[\s\S]*?:-)",  # Multiline comment
         ]
     ),
     flags=re.MULTILINE,
 )
 
+REGEX_COMMAND: re.Pattern[str] = re.compile(
+    r"^[ \t]*(?P<command>\S+)[ \t]+(?P<sub>\S+)(?:[ \t]+(?P<priority>\S+))?",
+    flags=re.MULTILINE,
+)
+
+MAX_READ_WORKERS: int = min(32, (os.cpu_count() or 1) * 4)
+USE_REFLINK: bool = sys.platform.startswith("linux")
+
 
 class GameEnum(StrEnum):
     """Enum class for games"""
@@ -50,12 +61,7 @@ class GameEnum(StrEnum):
         Returns:
             list[str]: List of strings containing the default paths of each game
         """
-        return {
-            GameEnum.HADES: ["Scritps/RoomManager.lua"],
-            GameEnum.PYRE: ["Scripts/Campaign.lua", "Scripts/MPScripts.lua"],
-            GameEnum.TRANSISTOR: ["Scripts/AllCampaignScripts.txt"],
-            GameEnum.BASTION: [""],
-        }[self]
+        return list(SCRIPT_PATHS[self])
 
     @staticmethod
     def guess_game(game_path: Path):
@@ -67,17 +73,155 @@ class GameEnum(StrEnum):
         Returns:
             GameEnum: Specific game, defaulting to Hades
         """
-        match game_path.parent.name:
-            case "Hades":
-                return GameEnum.HADES
-            case "Pyre":
-                return GameEnum.PYRE
-            case "Transistor":
-                return GameEnum.TRANSISTOR
-            case "Bastion":
-                return GameEnum.BASTION
-            case _:
-                return GameEnum.HADES
+        return GAMES_BY_FOLDER.get(game_path.parent.name, GameEnum.HADES)
+
+
+SCRIPT_PATHS: dict[GameEnum, tuple[str, ...]] = {
+    GameEnum.HADES: ("Scritps/RoomManager.lua",),
+    GameEnum.PYRE: ("Scripts/Campaign.lua", "Scripts/MPScripts.lua"),
+    GameEnum.TRANSISTOR: ("Scripts/AllCampaignScripts.txt",),
+    GameEnum.BASTION: ("",),
+}
+
+GAMES_BY_FOLDER: dict[str, GameEnum] = {
+    "Hades": GameEnum.HADES,
+    "Pyre": GameEnum.PYRE,
+    "Transistor": GameEnum.TRANSISTOR,
+    "Bastion": GameEnum.BASTION,
+}
+
+
+def _configure_logging() -> None:
+    """Configure the root logger with a rich handler once the cli runs"""
+    from rich.logging import RichHandler
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(message)s",
+        datefmt="[%X]",
+        handlers=[RichHandler()]
+        # handlers=[logging.FileHandler("cli.log", mode="w"), logging.StreamHandler()],
+    )
+
+
+def _scan_tree(root: str) -> Iterator[tuple[str, os.DirEntry]]:
+    """Traverse a directory tree using os.scandir, yielding parents before children
+
+    Symbolic links to folders are yielded but not followed.
+
+    Args:
+        root (str): Path to the directory to traverse
+
+    Yields:
+        tuple[str, os.DirEntry]: Path of each entry relative to root and the entry
+            itself
+    """
+    prefix_length = len(os.path.join(root, ""))
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                yield entry.path[prefix_length:], entry
+
+
+def _reflink(src: str, dst: str) -> bool:
+    """Clone a regular file with the FICLONE ioctl on copy-on-write file systems
+
+    Args:
+        src (str): Path to the source file
+        dst (str): Path to the destination file
+
+    Returns:
+        bool: False if the file could not be cloned
+    """
+    try:
+        src_fd = os.open(src, os.O_RDONLY | os.O_NONBLOCK)
+    except OSError:
+        return False
+    try:
+        src_stat = os.fstat(src_fd)
+        if not stat.S_ISREG(src_stat.st_mode):
+            return False
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_NONBLOCK, 0o666)
+        try:
+            dst_stat = os.fstat(dst_fd)
+            same_file = os.path.samestat(src_stat, dst_stat)
+            if same_file or not stat.S_ISREG(dst_stat.st_mode):
+                return False
+            os.ftruncate(dst_fd, 0)
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        finally:
+            os.close(dst_fd)
+    except OSError:
+        return False
+    finally:
+        os.close(src_fd)
+    return True
+
+
+def _copy_file(src: str, dst: str, reflink: bool = USE_REFLINK) -> bool:
+    """Copy a file, preferring a reflink and falling back to shutil.copyfile
+
+    Args:
+        src (str): Path to the source file
+        dst (str): Path to the destination file
+        reflink (bool): Try to clone the file before copying it
+
+    Raises:
+        shutil.SameFileError: Source and destination are the same file
+
+    Returns:
+        bool: True if the file was cloned, callers stop trying reflinks otherwise
+    """
+    if reflink and _reflink(src, dst):
+        return True
+    shutil.copyfile(src, dst)
+    return False
+
+
+def _hardlink(src: str, dst: str) -> bool:
+    """Hard link a file, replacing the destination if it already exists
+
+    Args:
+        src (str): Path to the source file
+        dst (str): Path to the destination file
+
+    Returns:
+        bool: False if the file could not be linked
+    """
+    try:
+        os.link(src, dst)
+    except FileExistsError:
+        try:
+            os.unlink(dst)
+            os.link(src, dst)
+        except OSError:
+            return False
+    except OSError:
+        return False
+    return True
+
+
+def _make_folders(folder: str, created_folders: set[str]) -> None:
+    """Create a folder unless it was already created, making parents only if missing
+
+    Args:
+        folder (str): Path to the folder
+        created_folders (set[str]): Folders known to exist, updated in place
+    """
+    if folder in created_folders:
+        return
+    try:
+        os.mkdir(folder)
+        LOGGER.debug('Created folder "%s"', folder)
+    except FileNotFoundError:
+        os.makedirs(folder, exist_ok=True)
+        LOGGER.debug('Created folder "%s"', folder)
+    except FileExistsError:
+        pass
+    created_folders.add(folder)
 
 
 def uninstall_mods(game_path: Path, backup_path: Path, modfolder_path: Path):
@@ -118,26 +262,46 @@ def uninstall_mods(game_path: Path, backup_path: Path, modfolder_path: Path):
     raise typer.Exit()
 
 
-def backup_files(file_list: List[Path], backup_path: Path) -> None:
-    """Backup all provided files to the backup directory, creating folders if necessary
+def backup_files(source_path: Path, backup_path: Path, hardlink: bool = False) -> None:
+    """Backup a folder into the backup directory, creating folders if necessary
+
+    Symbolic links to folders inside source_path are skipped with a warning. Hard
+    linked backups share their content with the game files, so they are only safe if
+    mods replace files instead of writing to them in place.
 
     Args:
-        file_list (List[Path]): List of files to backup
+        source_path (Path): Path to the folder to backup, must be a folder inside
+            the parent of backup_path
         backup_path (Path): Path to the backup folder
+        hardlink (bool): Hard link files instead of copying them, if possible
     """
-    for original_file in file_list:
-        destination_path = backup_path.joinpath(
-            original_file.relative_to(backup_path.parent)
-        )
-
-        if not destination_path.parent.exists():
-            LOGGER.debug('Creating folder "%s"', destination_path.parent)
-            destination_path.parent.mkdir(parents=True)
-        if original_file.is_dir():
-            destination_path.mkdir()
+    destination_str = str(
+        backup_path.joinpath(source_path.relative_to(backup_path.parent))
+    )
+    created_folders: set[str] = set()
+    reflink = USE_REFLINK
+    if hardlink:
+        _make_folders(str(backup_path), created_folders)
+        hardlink = os.stat(source_path).st_dev == os.stat(backup_path).st_dev
+    for rel_path, entry in _scan_tree(str(source_path)):
+        original_file = entry.path
+        destination_path = os.path.join(destination_str, rel_path)
+
+        if entry.is_dir(follow_symlinks=False):
+            _make_folders(destination_path, created_folders)
+            continue
+        if entry.is_symlink() and entry.is_dir():
+            LOGGER.warning('Folder "%s" is a symbolic link, skipping.', original_file)
+            continue
+        _make_folders(os.path.dirname(destination_path), created_folders)
+        if hardlink and _hardlink(original_file, destination_path):
+            LOGGER.debug('Linked file "%s" to "%s"', original_file, destination_path)
         else:
             LOGGER.debug('Copying file "%s" to "%s"', original_file, destination_path)
-            shutil.copyfile(original_file, destination_path)
+            try:
+                reflink = _copy_file(original_file, destination_path, reflink)
+            except shutil.SameFileError:
+                LOGGER.debug('File "%s" is already linked, skipping.', original_file)
 
 
 def restore_files(game_path: Path, backup_path: Path) -> None:
@@ -150,22 +314,25 @@ def restore_files(game_path: Path, backup_path: Path) -> None:
     Returns:
         Set[Path]: Returns a set of all restored files
     """
-    for item in backup_path.glob("**/*"):
-        original_path = game_path.joinpath(item.relative_to(backup_path)).resolve()
-        if original_path.is_dir():
-            original_path.mkdir(parents=True, exist_ok=True)
+    game_str = str(game_path)
+    backup_str = str(backup_path)
+    created_folders: set[str] = set()
+    reflink = USE_REFLINK
+    for rel_path, entry in _scan_tree(backup_str):
+        item = os.path.join(backup_str, rel_path)
+        original_path = os.path.join(game_str, rel_path)
+        if entry.is_dir(follow_symlinks=False):
+            _make_folders(original_path, created_folders)
         else:
-            original_path.parent.mkdir(parents=True, exist_ok=True)
+            _make_folders(os.path.dirname(original_path), created_folders)
 
             try:
-                shutil.copyfile(
-                    item.resolve(), game_path.joinpath(item.relative_to(backup_path))
-                )
-                LOGGER.info('Restoring file "%s" to "%s".', backup_path, original_path)
+                reflink = _copy_file(item, original_path, reflink)
+                LOGGER.info('Restoring file "%s" to "%s".', item, original_path)
             except shutil.SameFileError:
                 LOGGER.warning(
                     'Files "%s" and "%s" are identical, skipping.',
-                    backup_path,
+                    item,
                     original_path,
                 )
             except OSError:
@@ -186,48 +353,119 @@ def read_modfiles(modfolder_path: Path, game: GameEnum) -> List:
     """
     typer.echo(game.script_path)
     return []
-    for modfile in modfolder_path.glob("**/modfile.txt"):
-        with open(modfile, "r", encoding="utf-8-sig") as filehandle:
-            LOGGER.debug('Reading modfile "%s"', modfile)
-            file_content = filehandle.read()
-            substituted_content = re.sub(REGEX_SUBSTITUTION, "", file_content)
+    modfiles = [
+        modfolder_path.joinpath(rel_path)
+        for rel_path, is_dir in _scan_tree(str(modfolder_path))
+        if not is_dir and os.path.basename(rel_path) == "modfile.txt"
+    ]
+    with ThreadPoolExecutor(max_workers=MAX_READ_WORKERS) as executor:
+        for substituted_content in executor.map(_read_and_substitute, modfiles):
             load_mods(substituted_content)
 
     return []
 
 
+def _read_and_substitute(modfile: Path) -> str:
+    """Read a modfile and strip comments and empty lines
+
+    Args:
+        modfile (Path): Path to the modfile
+
+    Returns:
+        str: Modfile commands
+    """
+    with open(modfile, "rb") as filehandle:
+        LOGGER.debug('Reading modfile "%s"', modfile)
+        if os.fstat(filehandle.fileno()).st_size == 0:
+            return ""
+        with mmap.mmap(filehandle.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            start = len(BOM_UTF8) if mapped[: len(BOM_UTF8)] == BOM_UTF8 else 0
+            with memoryview(mapped) as view, view[start:] as file_content:
+                substituted_content = REGEX_SUBSTITUTION.sub(b"", file_content)
+    return substituted_content.decode("utf-8")
+
+
+def _handle_load(sub: str, priority: Optional[str]) -> None:
+    """Handle the load command, setting the priority of the following imports
+
+    Args:
+        sub (str): Subcommand
+        priority (Optional[str]): Priority of the following imports
+    """
+    if priority is None:
+        LOGGER.warning("Load command is missing a priority!")
+        return
+    try:
+        load_priority = int(priority)
+    except ValueError:
+        load_priority = int(float(priority))
+    LOGGER.debug("Loading the folloing imports with priority %d", load_priority)
+
+
+def _handle_import(sub: str, priority: Optional[str]) -> None:
+    """Handle the import command
+
+    Args:
+        sub (str): File to import
+        priority (Optional[str]): Unused
+    """
+    LOGGER.debug("Importing %s", sub)
+
+
+def _handle_to(sub: str, priority: Optional[str]) -> None:
+    """Handle the to command, changing the destination of the following imports
+
+    Args:
+        sub (str): New destination
+        priority (Optional[str]): Unused
+    """
+    LOGGER.debug("Changing destination for the following imports to %s", sub)
+
+
+def _handle_top(sub: str, priority: Optional[str]) -> None:
+    """Handle the top command, importing at the top of the destination file
+
+    Args:
+        sub (str): Subcommand
+        priority (Optional[str]): File to import
+    """
+    LOGGER.debug("Importing %s at the top of file %s.", priority, "")
+
+
+def _handle_unimplemented(sub: str, priority: Optional[str]) -> None:
+    """Accept a supported command that does not do anything yet
+
+    Args:
+        sub (str): Subcommand
+        priority (Optional[str]): Unused
+    """
+
+
+COMMAND_HANDLERS: dict[str, Callable[[str, Optional[str]], None]] = {
+    "load": _handle_load,
+    "import": _handle_import,
+    "to": _handle_to,
+    "top": _handle_top,
+    "xml": _handle_unimplemented,
+    "map": _handle_unimplemented,
+    "sjson": _handle_unimplemented,
+    "include": _handle_unimplemented,
+}
+
+
 def load_mods(modfile_commands: str):
     """Load modfile commands and execute them
 
     Args:
         modfile_commands (str): modfile commands
     """
-    for line in modfile_commands.splitlines():
-        command, sub, *priority = line.split()
-        match command.lower():
-            case "load":
-                LOGGER.debug(
-                    "Loading the folloing imports with priority %d",
-                    int(float(priority[0])),
-                )
-            case "import":
-                LOGGER.debug("Importing %s", sub)
-            case "to":
-                LOGGER.debug(
-                    "Changing destination for the following imports to %s", sub
-                )
-            case "top":
-                LOGGER.debug("Importing %s at the top of file %s.", priority, "")
-            case "xml":
-                pass
-            case "map":
-                pass
-            case "sjson":
-                pass
-            case "include":
-                pass
-            case _:
-                LOGGER.warning('Command "%s" is not supported!', command)
+    for command_match in REGEX_COMMAND.finditer(modfile_commands):
+        command, sub, priority = command_match.group("command", "sub", "priority")
+        handler = COMMAND_HANDLERS.get(command.lower())
+        if handler:
+            handler(sub, priority)
+        else:
+            LOGGER.warning('Command "%s" is not supported!', command)
 
 
 def cli(
@@ -258,6 +496,7 @@ def cli(
     ] = False,
 ) -> None:
     """Supergiant Games Mod Manager helps you manage your mods for their games."""
+    _configure_logging()
     if verbose:
         LOGGER.setLevel(logging.DEBUG)
 
@@ -292,7 +531,7 @@ def cli(
         backup_path.mkdir()
 
     read_modfiles(modfolder_path, game)
-    # backup_files(list(game_path.joinpath("Scripts").glob("**/*")), backup_path)
+    # backup_files(game_path.joinpath("Scripts"), backup_path)
     # apply_mods()
 
 
@@ -0,0 +1,347 @@
+"""
+Tests for the file handling and modfile parsing of the command line interface
+"""
+import errno
+import logging
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+import typer
+from typer.testing import CliRunner
+
+from sggmm import cli
+
+
+@pytest.fixture(name="game_path")
+def fixture_game_path(tmp_path):
+    """Game folder containing a small script tree and an empty backup folder"""
+    game_path = tmp_path / "Hades" / "Content"
+    game_path.joinpath("Scripts", "Sub").mkdir(parents=True)
+    game_path.joinpath("Scripts", "RoomManager.lua").write_text("original")
+    game_path.joinpath("Scripts", "Sub", "Nested.lua").write_text("nested")
+    game_path.joinpath("Backup").mkdir()
+    return game_path
+
+
+def _commands(caplog, modfile_commands):
+    """Run load_mods and return the logged messages"""
+    caplog.clear()
+    with caplog.at_level(logging.DEBUG, logger=cli.LOGGER.name):
+        cli.load_mods(modfile_commands)
+    return [record.getMessage() for record in caplog.records]
+
+
+def test_scan_tree(tmp_path):
+    """Yield every entry relative to the root, parents before children"""
+    tmp_path.joinpath("a", "b").mkdir(parents=True)
+    tmp_path.joinpath("a", "b", "file").write_text("")
+    tmp_path.joinpath("file").write_text("")
+    entries = [
+        (rel_path, entry.is_dir()) for rel_path, entry in cli._scan_tree(str(tmp_path))
+    ]
+    assert sorted(entries) == [
+        ("a", True),
+        (os.path.join("a", "b"), True),
+        (os.path.join("a", "b", "file"), False),
+        ("file", False),
+    ]
+    paths = [rel_path for rel_path, _ in entries]
+    assert paths.index("a") < paths.index(os.path.join("a", "b", "file"))
+
+
+def test_regex_substitution(caplog):
+    """Strip leading whitespace, empty lines and multiline comments"""
+    modfile_content = b'  Load Priority 100\n-: multi\nline :-\n\nImport "a.lua"\n'
+    substituted_content = cli.REGEX_SUBSTITUTION.sub(b"", modfile_content)
+    assert _commands(caplog, substituted_content.decode()) == [
+        "Loading the folloing imports with priority 100",
+        'Importing "a.lua"',
+    ]
+
+
+def test_script_path():
+    """Return a new list of default scripts on every access"""
+    script_path = cli.GameEnum.PYRE.script_path
+    assert script_path == ["Scripts/Campaign.lua", "Scripts/MPScripts.lua"]
+    script_path.append("Scripts/Other.lua")
+    assert cli.GameEnum.PYRE.script_path == [
+        "Scripts/Campaign.lua",
+        "Scripts/MPScripts.lua",
+    ]
+
+
+@pytest.mark.parametrize(
+    ("folder", "game"),
+    [
+        ("Hades", cli.GameEnum.HADES),
+        ("Pyre", cli.GameEnum.PYRE),
+        ("Transistor", cli.GameEnum.TRANSISTOR),
+        ("Bastion", cli.GameEnum.BASTION),
+        ("Other", cli.GameEnum.HADES),
+    ],
+)
+def test_guess_game(tmp_path, folder, game):
+    """Guess the game from the folder name, defaulting to Hades"""
+    assert cli.GameEnum.guess_game(tmp_path / folder / "Content") == game
+
+
+def test_make_folders(tmp_path):
+    """Create missing parents and skip folders that were already created"""
+    folder = str(tmp_path / "a" / "b")
+    created_folders: set[str] = set()
+    cli._make_folders(folder, created_folders)
+    assert os.path.isdir(folder)
+    assert folder in created_folders
+
+    os.rmdir(folder)
+    cli._make_folders(folder, created_folders)
+    assert not os.path.exists(folder)
+
+
+def test_make_folders_existing(tmp_path):
+    """Accept folders that already exist on disk"""
+    folder = str(tmp_path / "a")
+    os.mkdir(folder)
+    created_folders: set[str] = set()
+    cli._make_folders(folder, created_folders)
+    assert created_folders == {folder}
+
+
+def test_read_and_substitute(caplog, tmp_path):
+    """Strip the BOM, comments and empty lines from a modfile"""
+    modfile = tmp_path / "modfile.txt"
+    modfile.write_bytes(
+        b'\xef\xbb\xbf  Load Priority 100\n-: multi\nline :-\n\nImport "a.lua"\n'
+    )
+    assert _commands(caplog, cli._read_and_substitute(modfile)) == [
+        "Loading the folloing imports with priority 100",
+        'Importing "a.lua"',
+    ]
+
+
+def test_read_and_substitute_empty(tmp_path):
+    """Return no commands for an empty modfile"""
+    modfile = tmp_path / "modfile.txt"
+    modfile.write_bytes(b"")
+    assert cli._read_and_substitute(modfile) == ""
+
+
+@pytest.mark.parametrize("newline", [b"\n", b"\r\n"])
+def test_read_and_substitute_comments(caplog, tmp_path, newline):
+    """Keep the commands around comments apart, regardless of line endings"""
+    modfile = tmp_path / "modfile.txt"
+    modfile.write_bytes(
+        newline.join(
+            [
+                b'To "b.lua"',
+                b":: comment",
+                b'Import "a.lua" :: comment',
+                b'-: header :-  Import "c.lua"',
+                b'Import "d.lua"',
+            ]
+        )
+    )
+    assert _commands(caplog, cli._read_and_substitute(modfile)) == [
+        'Changing destination for the following imports to "b.lua"',
+        'Importing "a.lua"',
+        'Importing "c.lua"',
+        'Importing "d.lua"',
+    ]
+
+
+def test_load_mods(caplog):
+    """Dispatch each command to its handler"""
+    assert _commands(caplog, 'Load Priority 100\nTo "b.lua"\nImport "a.lua"') == [
+        "Loading the folloing imports with priority 100",
+        'Changing destination for the following imports to "b.lua"',
+        'Importing "a.lua"',
+    ]
+
+
+def test_load_mods_unsupported(caplog):
+    """Warn about unsupported commands"""
+    assert _commands(caplog, "Foo bar") == ['Command "Foo" is not supported!']
+
+
+def test_load_mods_indented(caplog):
+    """Accept commands preceded by blanks"""
+    assert _commands(caplog, '  Import "a.lua"\n\tImport "b.lua"') == [
+        'Importing "a.lua"',
+        'Importing "b.lua"',
+    ]
+
+
+def test_load_mods_trailing_tokens(caplog):
+    """Use the first token after the subcommand as priority and ignore the rest"""
+    assert _commands(caplog, "Load Priority 100 extra\r\nLoad Priority 2.5") == [
+        "Loading the folloing imports with priority 100",
+        "Loading the folloing imports with priority 2",
+    ]
+
+
+def test_load_mods_missing_priority(caplog):
+    """Warn about load commands without a priority instead of raising"""
+    assert _commands(caplog, 'Load Priority\nImport "a.lua"') == [
+        "Load command is missing a priority!",
+        'Importing "a.lua"',
+    ]
+
+
+def test_load_mods_unimplemented(caplog):
+    """Accept supported commands that do not do anything yet without warnings"""
+    assert _commands(caplog, "XML a\nMap b\nSJSON c\nInclude d") == []
+
+
+def test_restore_files(caplog, game_path):
+    """Restore modified files from the backup and log each restored file"""
+    backup_file = game_path.joinpath("Backup", "Scripts", "RoomManager.lua")
+    backup_file.parent.mkdir()
+    backup_file.write_text("backup")
+    game_file = game_path.joinpath("Scripts", "RoomManager.lua")
+    with caplog.at_level(logging.INFO, logger=cli.LOGGER.name):
+        cli.restore_files(game_path, game_path / "Backup")
+    assert game_file.read_text() == "backup"
+    assert f'Restoring file "{backup_file}" to "{game_file}".' in caplog.messages
+
+
+def test_backup_and_restore_files(game_path):
+    """Restore modified files and deleted folders from the backup"""
+    backup_path = game_path / "Backup"
+    cli.backup_files(game_path / "Scripts", backup_path)
+    assert backup_path.joinpath("Scripts", "Sub", "Nested.lua").read_text() == "nested"
+
+    game_path.joinpath("Scripts", "RoomManager.lua").write_text("modded")
+    shutil.rmtree(game_path / "Scripts" / "Sub")
+    cli.restore_files(game_path, backup_path)
+    assert game_path.joinpath("Scripts", "RoomManager.lua").read_text() == "original"
+    assert game_path.joinpath("Scripts", "Sub", "Nested.lua").read_text() == "nested"
+
+
+def test_backup_files_symlinked_folder(caplog, game_path, tmp_path):
+    """Skip symbolic links to folders with a warning instead of failing"""
+    linked_folder = tmp_path / "Linked"
+    linked_folder.mkdir()
+    linked_folder.joinpath("Linked.lua").write_text("linked")
+    link = game_path.joinpath("Scripts", "Link")
+    try:
+        link.symlink_to(linked_folder, target_is_directory=True)
+    except OSError:
+        pytest.skip("Creating symbolic links is not supported")
+
+    with caplog.at_level(logging.WARNING, logger=cli.LOGGER.name):
+        cli.backup_files(game_path / "Scripts", game_path / "Backup")
+    assert f'Folder "{link}" is a symbolic link, skipping.' in caplog.messages
+    assert not game_path.joinpath("Backup", "Scripts", "Link").exists()
+    assert game_path.joinpath("Backup", "Scripts", "RoomManager.lua").exists()
+
+
+def test_import_leaves_logging_unconfigured():
+    """Importing the module must not add handlers to the root logger"""
+    subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import logging, sggmm.cli; assert not logging.getLogger().handlers",
+        ],
+        check=True,
+    )
+
+
+def test_cli_configures_logging(game_path, monkeypatch):
+    """Configure logging once the cli runs"""
+    calls = []
+    monkeypatch.setattr(cli, "_configure_logging", lambda: calls.append(True))
+    game_path.joinpath("Mods").mkdir()
+    app = typer.Typer()
+    app.command()(cli.cli)
+    result = CliRunner().invoke(app, [str(game_path)])
+    assert result.exit_code == 0, result.output
+    assert calls == [True]
+
+
+def test_backup_hardlink(game_path):
+    """Hard link files into a backup folder that does not exist yet"""
+    backup_path = game_path / "Backup"
+    backup_path.rmdir()
+    cli.backup_files(game_path / "Scripts", backup_path, hardlink=True)
+    assert backup_path.joinpath("Scripts", "RoomManager.lua").samefile(
+        game_path.joinpath("Scripts", "RoomManager.lua")
+    )
+
+
+def test_backup_over_hardlinked_backup(game_path):
+    """Skip files that are already hard linked into the backup"""
+    backup_path = game_path / "Backup"
+    cli.backup_files(game_path / "Scripts", backup_path, hardlink=True)
+    cli.backup_files(game_path / "Scripts", backup_path)
+    assert backup_path.joinpath("Scripts", "RoomManager.lua").read_text() == "original"
+
+
+def test_hardlink_over_folder(tmp_path):
+    """Report a failure instead of raising if the destination is a folder"""
+    src = tmp_path / "src"
+    src.write_text("")
+    dst = tmp_path / "dst"
+    dst.mkdir()
+    assert not cli._hardlink(str(src), str(dst))
+    assert dst.is_dir()
+
+
+def test_copy_file(tmp_path):
+    """Replace the whole content of an existing destination"""
+    src = tmp_path / "src"
+    src.write_text("new")
+    dst = tmp_path / "dst"
+    dst.write_text("much longer old content")
+    cli._copy_file(str(src), str(dst))
+    assert dst.read_text() == "new"
+
+
+def test_copy_file_reflink_unsupported(tmp_path, monkeypatch):
+    """Fall back to a regular copy if the file system cannot clone files"""
+    if not cli.USE_REFLINK:
+        pytest.skip("Reflinks are only attempted on Linux")
+
+    def ioctl(*_):
+        raise OSError(errno.EOPNOTSUPP, os.strerror(errno.EOPNOTSUPP))
+
+    monkeypatch.setattr(cli.fcntl, "ioctl", ioctl)
+    src = tmp_path / "src"
+    src.write_text("content")
+    dst = tmp_path / "dst"
+    assert not cli._copy_file(str(src), str(dst))
+    assert dst.read_text() == "content"
+
+
+def test_backup_files_stops_reflinks(game_path, monkeypatch):
+    """Only try to clone files until the first reflink fails"""
+    calls = []
+    monkeypatch.setattr(cli, "USE_REFLINK", True)
+    monkeypatch.setattr(cli, "_reflink", lambda *args: calls.append(args) and False)
+    cli.backup_files(game_path / "Scripts", game_path / "Backup")
+    assert len(calls) == 1
+    assert game_path.joinpath("Backup", "Scripts", "Sub", "Nested.lua").exists()
+
+
+def test_copy_file_same_file(tmp_path):
+    """Refuse to copy a file onto a hard link of itself without truncating it"""
+    src = tmp_path / "src"
+    src.write_text("content")
+    dst = tmp_path / "dst"
+    os.link(src, dst)
+    with pytest.raises(shutil.SameFileError):
+        cli._copy_file(str(src), str(dst))
+    assert src.read_text() == "content"
+
+
+def test_copy_file_named_pipe(tmp_path):
+    """Refuse to copy from a named pipe instead of blocking on it"""
+    if not hasattr(os, "mkfifo"):
+        pytest.skip("Named pipes are not supported")
+    src = tmp_path / "src"
+    os.mkfifo(src)
+    with pytest.raises(shutil.SpecialFileError):
+        cli._copy_file(str(src), str(tmp_path / "dst"))